@@ -1,87 +1,272 @@
+import hashlib
+import io
+import os
+import queue
+import threading
+import time
 import streamlit as st
 import pandas as pd
+import numpy as np
 import altair as alt
+import pyarrow as pa
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
+from pathlib import Path
 from esma_data_py import EsmaDataLoader
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 st.set_page_config(page_title="ESMA Regulatory Data Explorer", layout="wide")
 st.title("📊 ESMA Regulatory Data Explorer – Stable Edition")
 
-edl = EsmaDataLoader()
+# Loader (and its HTTP session) is shared across reruns and sessions
+@st.cache_resource
+def get_loader():
+    return EsmaDataLoader()
+
+edl = get_loader()
 
 # Utility: safe datetime conversion
 def safe_datetime(series):
     return pd.to_datetime(series, errors="coerce").dt.tz_localize(None)
 
+# Utility: table preview; a RangeIndex is sent as Arrow metadata, not as an extra column
+def show_table(df, rows=None):
+    if rows is not None:
+        df = df.head(rows)
+    st.dataframe(df.reset_index(drop=True), hide_index=True)
+
 # Utility: schema viewer
 def show_schema(df, label):
     with st.expander(f"📄 Schema: {label}"):
-        st.dataframe(pd.DataFrame({
+        show_table(pd.DataFrame({
             "Column": df.columns,
             "Type": df.dtypes.astype(str)
         }))
 
+# Utility: shrink frames before caching (narrow integers, categorical labels)
+CATEGORY_COLUMNS = ("instrument_type", "cfi_code", "issuer_name", "file_name")
+
+def optimize_dtypes(df):
+    if not df.columns.is_unique:
+        return df  # label lookups would return frames; leave such files as downloaded
+    for col in df.select_dtypes("integer").columns:
+        df[col] = pd.to_numeric(df[col], downcast="integer")
+    for col in CATEGORY_COLUMNS:
+        if col in df.columns and pd.api.types.is_string_dtype(df[col]) and df[col].nunique() < len(df) // 2:
+            df[col] = df[col].astype("category")
+    return df
+
+# Utility: literal substring mask; categoricals are matched on their (few) categories
+def contains(series, needle, case=True):
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        categories = series.cat.categories
+        hits = categories[categories.astype(str).str.contains(needle, case=case, regex=False)]
+        return series.isin(hits).to_numpy()
+    return series.astype(str).str.contains(needle, case=case, na=False, regex=False).to_numpy()
+
+# Cached loaders: metadata is fetched and parsed once per hour, not on every rerun
+@st.cache_data(ttl=3600, show_spinner=False)
+def load_mifid_files():
+    files = edl.load_mifid_file_list()
+    if files.empty:
+        return files, pd.DatetimeIndex([])
+    optimize_dtypes(files)
+    files["publication_date"] = safe_datetime(files["publication_date"])
+    pub_dates = pd.DatetimeIndex(files["publication_date"].dropna().unique()).sort_values(ascending=False)
+    return files, pub_dates
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def load_firds_files():
+    files = optimize_dtypes(edl.load_latest_files())
+    if "publication_date" in files.columns:
+        files["publication_date"] = safe_datetime(files["publication_date"])
+    return files
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def load_ssr_shares():
+    df = optimize_dtypes(edl.load_ssr_exempted_shares())
+    if "publication_date" in df.columns:
+        df["publication_date"] = safe_datetime(df["publication_date"])
+    # Lower-cased once here so issuer filtering doesn't case-fold on every keystroke
+    issuer_lc = df["issuer_name"].astype(str).str.lower() if "issuer_name" in df.columns else None
+    return df, issuer_lc
+
+# Download workers get the session's script context, so the cached helpers run without
+# "missing ScriptRunContext" warnings
+def init_download_worker(ctx):
+    add_script_run_ctx(threading.current_thread(), ctx)
+
+# Loaders for file downloads, kept across clicks and sessions so their HTTP sessions are
+# reused. EsmaDataLoader is not documented as thread-safe, so each one is lent to a single
+# thread at a time; a new one is only built when every pooled loader is busy.
+@st.cache_resource
+def get_download_loaders():
+    return queue.SimpleQueue()
+
+@contextmanager
+def borrow_download_loader():
+    loaders = get_download_loaders()
+    try:
+        loader = loaders.get_nowait()
+    except queue.Empty:
+        loader = EsmaDataLoader()
+    try:
+        yield loader
+    finally:
+        loaders.put(loader)
+
+# Utility: on-disk Parquet copy of each published file, so restarts and cache
+# evictions re-read a local file instead of re-downloading and re-parsing it.
+# Entries expire after DOWNLOAD_CACHE_TTL, so republished files are picked up, and
+# the oldest are pruned once the directory grows past DOWNLOAD_CACHE_MAX_BYTES.
+DOWNLOAD_CACHE_DIR = Path(__file__).parent / ".cache" / "esma"
+DOWNLOAD_CACHE_TTL = 86400
+DOWNLOAD_CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+def prune_download_cache():
+    entries = []
+    for path in DOWNLOAD_CACHE_DIR.iterdir():
+        try:
+            info = path.stat()
+        except OSError:
+            continue
+        entries.append((info.st_mtime, info.st_size, path))
+    now, total = time.time(), 0
+    for mtime, size, path in sorted(entries, reverse=True):
+        total += size
+        if now - mtime > DOWNLOAD_CACHE_TTL or total > DOWNLOAD_CACHE_MAX_BYTES:
+            path.unlink(missing_ok=True)
+
+def read_download(url):
+    path = DOWNLOAD_CACHE_DIR / f"{hashlib.sha1(url.encode()).hexdigest()}.parquet"
+    try:
+        if time.time() - path.stat().st_mtime < DOWNLOAD_CACHE_TTL:
+            return pd.read_parquet(path)
+    except (OSError, pa.ArrowException):
+        pass  # missing, unreadable or corrupt entries are downloaded again
+    with borrow_download_loader() as loader:
+        df = loader.download_file(url)
+    df = optimize_dtypes(df).reset_index(drop=True)
+    # The disk copy is best-effort: a read-only or full disk, or a frame Arrow can't
+    # store, only skips caching
+    tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        DOWNLOAD_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        df.to_parquet(tmp, compression="zstd")
+        os.replace(tmp, path)
+        prune_download_cache()
+    except (OSError, ValueError, TypeError, pa.ArrowException):
+        tmp.unlink(missing_ok=True)
+    return df
+
+# Downloads are keyed by URL; max_entries bounds how many parsed files stay in memory.
+# Frames are cached as Arrow (Feather) bytes, which are cheaper to store than pickled objects;
+# frames Feather can't store (object columns mixing ints and strs, repeated column
+# names) are cached as-is.
+@st.cache_data(ttl=DOWNLOAD_CACHE_TTL, max_entries=32, show_spinner=False)
+def download_feather(url):
+    df = read_download(url)
+    buf = io.BytesIO()
+    try:
+        df.to_feather(buf)
+    except (ValueError, TypeError, pa.ArrowException):
+        return df
+    return buf.getvalue()
+
+def download_file(url):
+    cached = download_feather(url)
+    if isinstance(cached, bytes):
+        return pd.read_feather(io.BytesIO(cached))
+    return cached
+
+# Utility: CSV export, serialized once per frame instead of on every rerun
+@st.cache_data(max_entries=8, show_spinner=False)
+def to_csv_bytes(df):
+    buf = io.BytesIO()
+    df.to_csv(buf, index=False, encoding="utf-8")
+    return buf.getvalue()
+
+# Utility: monthly record counts for trend charts
+@st.cache_data(max_entries=8, show_spinner=False)
+def monthly_trend(dates):
+    months, counts = np.unique(dates.dropna().to_numpy().astype("datetime64[M]"), return_counts=True)
+    return pd.DataFrame({"month": months.astype("datetime64[ns]"), "count": counts})
+
 # Dataset selector
 dataset = st.sidebar.radio("Select dataset", ["MiFID", "FIRDS", "SSR"])
 
 # ------------------- MiFID -------------------
-if dataset == "MiFID":
+@st.fragment
+def mifid_section():
     st.header("🧾 MiFID II")
     try:
-        files = edl.load_mifid_file_list()
+        files, pub_dates = load_mifid_files()
         if files.empty:
             st.warning("No MiFID metadata found.")
         else:
-            files["publication_date"] = safe_datetime(files["publication_date"])
             show_schema(files, "MiFID File Metadata")
 
             # Date filtering
-            min_date = files["publication_date"].min()
-            max_date = files["publication_date"].max()
+            min_date, max_date = pub_dates[-1], pub_dates[0]
             start_date, end_date = st.date_input("📅 Filter by publication date range",
                                                  [min_date, max_date])
-            start_date = pd.to_datetime(start_date)
-            end_date = pd.to_datetime(end_date)
-
+            pub = files["publication_date"].to_numpy()
             filtered = files[
-                (files["publication_date"] >= start_date) &
-                (files["publication_date"] <= end_date)
+                (pub >= np.datetime64(start_date, "ns")) &
+                (pub <= np.datetime64(end_date, "ns"))
             ]
 
             st.subheader(f"{len(filtered)} files found")
-            st.dataframe(filtered)
+            show_table(filtered)
 
             selected_files = st.multiselect("Select files to download and analyze", filtered["file_name"])
             if st.button("📥 Download & Analyze Selected"):
-                combined = pd.DataFrame()
+                link_cols = [c for c in ("download_link", "downloadUrl") if c in filtered.columns]
+                selected = filtered[filtered["file_name"].isin(selected_files)].drop_duplicates("file_name")
+                links_by_name = selected.set_index("file_name")[link_cols].to_dict("index")
+                urls = {}
                 for fname in selected_files:
-                    row = filtered[filtered["file_name"] == fname].iloc[0]
-                    url = row.get("download_link") or row.get("downloadUrl")
+                    # Links are in link_cols order, so download_link wins over downloadUrl
+                    url = next((u for u in links_by_name[fname].values() if pd.notna(u) and u), None)
                     if not url:
                         st.warning(f"No download URL for {fname}")
                         continue
-                    df = edl.download_file(url)
-                    df["source_file"] = fname
-                    combined = pd.concat([combined, df], ignore_index=True)
+                    urls[fname] = url
+
+                # Downloads are I/O-bound, so fetch them concurrently
+                parts = []
+                if urls:
+                    with st.spinner("Downloading…"), ThreadPoolExecutor(
+                            max_workers=min(8, len(urls)),
+                            initializer=init_download_worker,
+                            initargs=(get_script_run_ctx(),)) as pool:
+                        for fname, df in zip(urls, pool.map(download_file, urls.values())):
+                            df["source_file"] = fname
+                            parts.append(df)
+                combined = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame()
 
                 if not combined.empty:
                     st.subheader("🔍 Combined Preview")
                     search = st.text_input("Search within combined data")
                     if search:
-                        combined = combined[combined.astype(str).apply(
-                            lambda r: r.str.contains(search, case=False, na=False), axis=1
-                        )]
-                    st.dataframe(combined.head(100))
-                    st.download_button("⬇ Download Combined CSV", combined.to_csv(index=False), "mifid_combined.csv")
+                        mask = np.zeros(len(combined), dtype=bool)
+                        text = combined.select_dtypes(include=["object", "string", "category"])
+                        for i in range(text.shape[1]):  # by position: column names may repeat
+                            mask |= contains(text.iloc[:, i], search, case=False)
+                        combined = combined[mask]
+                    show_table(combined, 100)
+                    st.download_button("⬇ Download Combined CSV", to_csv_bytes(combined), "mifid_combined.csv", mime="text/csv")
                     show_schema(combined, "Combined MiFID Data")
     except Exception as e:
         st.error(f"MiFID error: {e}")
 
 # ------------------- FIRDS -------------------
-elif dataset == "FIRDS":
+@st.fragment
+def firds_section():
     st.header("📂 FIRDS Instrument Reference Data")
     try:
-        files = edl.load_latest_files()
+        files = load_firds_files()
         if files.empty:
             st.warning("No FIRDS metadata available.")
         else:
@@ -90,73 +275,84 @@ elif dataset == "FIRDS":
             isin = st.text_input("Filter by ISIN (optional)").strip().upper()
             cfi = st.text_input("Filter by CFI Code (optional)").strip().upper()
 
-            if isin:
-                files = files[files["isin"].astype(str).str.contains(isin, na=False)]
-            if cfi:
-                files = files[files["cfi_code"].astype(str).str.contains(cfi, na=False)]
+            active = []
+            for col, needle in (("isin", isin), ("cfi_code", cfi)):
+                if needle and col not in files.columns:
+                    st.warning(f"{col} not available; filter ignored")
+                elif needle:
+                    active.append((col, needle))
+            if active:
+                mask = np.ones(len(files), dtype=bool)
+                for col, needle in active:
+                    mask &= contains(files[col], needle)
+                files = files[mask]
 
             st.subheader(f"{len(files)} records found")
-            st.dataframe(files.head(100))
-            st.download_button("⬇ Download FIRDS CSV", files.to_csv(index=False), "firds_filtered.csv")
+            show_table(files, 100)
+            st.download_button("⬇ Download FIRDS CSV", to_csv_bytes(files), "firds_filtered.csv", mime="text/csv")
 
             if not files.empty:
                 st.subheader("📋 Instrument Summary")
-                summary = files.groupby("isin", as_index=False).agg({
-                    "issuer_name": "first",
-                    "maturity_date": "first",
-                    "cfi_code": "first"
-                })
-                st.dataframe(summary.head(50))
-                st.download_button("⬇ Download Summary CSV", summary.to_csv(index=False), "firds_summary.csv")
+                summary = (files[["isin", "issuer_name", "maturity_date", "cfi_code"]]
+                           .dropna(subset=["isin"])
+                           .drop_duplicates(subset="isin", keep="first", ignore_index=True))
+                show_table(summary, 50)
+                st.download_button("⬇ Download Summary CSV", to_csv_bytes(summary), "firds_summary.csv", mime="text/csv")
     except Exception as e:
         st.error(f"FIRDS error: {e}")
 
 # ------------------- SSR -------------------
-elif dataset == "SSR":
+@st.fragment
+def ssr_section():
     st.header("📉 SSR Short Selling Exemptions")
     try:
-        df = edl.load_ssr_exempted_shares()
+        df, issuer_lc = load_ssr_shares()
         if df.empty:
             st.warning("No SSR data.")
         else:
             show_schema(df, "SSR Data")
 
             issuer = st.text_input("Filter by Issuer Name (optional)").strip()
-            if issuer:
-                df = df[df["issuer_name"].astype(str).str.contains(issuer, case=False, na=False)]
+            if issuer and issuer_lc is not None:
+                df = df[issuer_lc.str.contains(issuer.lower(), na=False, regex=False)]
 
             st.subheader(f"{len(df)} records found")
-            st.dataframe(df.head(100))
-            st.download_button("⬇ Download SSR CSV", df.to_csv(index=False), "ssr_filtered.csv")
+            show_table(df, 100)
+            st.download_button("⬇ Download SSR CSV", to_csv_bytes(df), "ssr_filtered.csv", mime="text/csv")
 
             if "publication_date" in df.columns:
-                df["publication_date"] = safe_datetime(df["publication_date"])
-                df["month"] = df["publication_date"].dt.to_period("M").astype(str)
-                trend = df.groupby("month").size().reset_index(name="count")
-                trend["month"] = pd.to_datetime(trend["month"])
-                st.subheader("📈 SSR Monthly Trend")
-                chart = alt.Chart(trend).mark_line(point=True).encode(
-                    x=alt.X("month:T", title="Month"),
-                    y=alt.Y("count:Q", title="Records")
-                )
-                st.altair_chart(chart, use_container_width=True)
+                with st.expander("📈 SSR Monthly Trend", expanded=False):
+                    trend = monthly_trend(df["publication_date"])
+                    chart = alt.Chart(trend).mark_line(point=True).encode(
+                        x=alt.X("month:T", title="Month"),
+                        y=alt.Y("count:Q", title="Records")
+                    )
+                    st.altair_chart(chart, use_container_width=True)
     except Exception as e:
         st.error(f"SSR error: {e}")
 
+# Each section is a fragment: its own widgets rerun only that section
+if dataset == "MiFID":
+    mifid_section()
+elif dataset == "FIRDS":
+    firds_section()
+elif dataset == "SSR":
+    ssr_section()
+
 # ------------------- Freshness Check -------------------
 st.markdown("---")
 st.subheader("📅 Data Freshness Overview")
 try:
-    mifid_files = edl.load_mifid_file_list()
-    mifid_latest = safe_datetime(mifid_files["publication_date"]).max()
+    _, mifid_dates = load_mifid_files()
+    mifid_latest = mifid_dates[0]
     st.write(f"Latest MiFID publication: **{mifid_latest.date()}** ({(datetime.now() - mifid_latest).days} days ago)")
-except: pass
+except Exception: pass
 
 try:
-    firds_files = edl.load_latest_files()
+    firds_files = load_firds_files()
     if "publication_date" in firds_files.columns:
-        firds_latest = safe_datetime(firds_files["publication_date"]).max()
+        firds_latest = firds_files["publication_date"].max()
         st.write(f"Latest FIRDS publication: **{firds_latest.date()}** ({(datetime.now() - firds_latest).days} days ago)")
-except: pass
+except Exception: pass
 
 st.markdown("Built with ❤️ using Streamlit & `esma_data_py`")